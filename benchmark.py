@@ -0,0 +1,250 @@
+"""
+离线基准测试：在本地启动模拟的 sbsub 数据源和 Alist 服务，驱动若干轮完整的检查流程，
+并报告每轮的耗时、HTTP 请求次数和内存占用，无需真实的 Alist 实例或网络连接。
+
+用法示例:
+    python benchmark.py --episodes 1500 --start-episode 1400 --done 5000 --cycles 3 --latency-ms 20
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DOWNLOAD_PATH = "/bench/conan"
+
+
+class FakeServerState:
+    """模拟服务共享的数据：剧集目录、已完成转存列表、下载目录树，以及按路径统计的请求次数。"""
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.rng = random.Random(args.seed)
+        self.catalog = self._build_catalog(args.episodes)
+        self.catalog_body = json.dumps(self.catalog, ensure_ascii=False).encode("utf-8")
+        self.done = [{"id": f"old-{i}", "name": f"transfer [/tmp/[SBSUB][CONAN][{i % max(args.start_episode, 1)}][WEBRIP][1080P].mkv] to [{DOWNLOAD_PATH}]", "state": 2}
+                     for i in range(args.done)]
+        self.fs = {DOWNLOAD_PATH: [{"name": f"filler-{i}.txt", "is_dir": False} for i in range(args.filler)]}
+        for i in range(args.filler_dirs):
+            self.fs[DOWNLOAD_PATH].append({"name": f"other-{i}", "is_dir": True})
+            self.fs[f"{DOWNLOAD_PATH}/other-{i}"] = [{"name": f"file-{j}.bin", "is_dir": False} for j in range(10)]
+        self.task_seq = 0
+        self.outstanding = []
+
+    @staticmethod
+    def _build_catalog(count):
+        tv_shows = {}
+        for i in range(1, count + 1):
+            magnet = f"magnet:?xt=urn:btih:{i:040x}"
+            tv_shows[str(i)] = [str(i), f"第{i}集标题", "", "", "", "", "", {"WEBRIP": [["1080P", "简繁日MKV", magnet]]}]
+        return {"res": [[None, None, None, None, tv_shows]]}
+
+    def submit_download(self, magnet):
+        """模拟添加离线下载：任务进入未完成队列，由 complete_outstanding 在之后的轮次中完成。"""
+        with self.lock:
+            self.task_seq += 1
+            task_id = f"bench-{self.task_seq}"
+            self.outstanding.append((task_id, magnet))
+        return {"id": task_id, "name": f"download {magnet} to ({DOWNLOAD_PATH})", "state": 0}
+
+    def complete_outstanding(self, fraction):
+        """按比例完成未完成队列中的任务 (至少一个)，返回本次完成的数量。"""
+        with self.lock:
+            count = min(len(self.outstanding), max(1, math.ceil(len(self.outstanding) * fraction))) if self.outstanding else 0
+            finished, self.outstanding = self.outstanding[:count], self.outstanding[count:]
+        for task_id, magnet in finished:
+            self._complete_download(task_id, magnet)
+        return count
+
+    def _complete_download(self, task_id, magnet):
+        """模拟离线下载和转存完成：生成已完成转存记录，并在下载目录中放入文件 (偶数集放在子目录中)。"""
+        episode = int(magnet.split("urn:btih:")[1][:40], 16)
+        file_name = f"[SBSUB][CONAN][{episode}][WEBRIP][1080P][CHS_JPN].mkv"
+        with self.lock:
+            self.done.append({"id": f"transfer-{task_id}", "name": f"transfer [/tmp/{file_name}] to [{DOWNLOAD_PATH}]", "state": 2})
+            if episode % 2 == 0:
+                sub_dir = f"[SBSUB][CONAN][{episode}][WEBRIP]"
+                self.fs[DOWNLOAD_PATH].append({"name": sub_dir, "is_dir": True})
+                self.fs[f"{DOWNLOAD_PATH}/{sub_dir}"] = [{"name": file_name, "is_dir": False}, {"name": "readme.txt", "is_dir": False}]
+            else:
+                self.fs[DOWNLOAD_PATH].append({"name": file_name, "is_dir": False})
+
+    def rename(self, path, new_name):
+        directory, old_name = os.path.split(path)
+        with self.lock:
+            for item in self.fs.get(directory, []):
+                if item["name"] == old_name:
+                    item["name"] = new_name
+                    return True
+        return False
+
+
+def make_handler(shared, serve_catalog):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 响应头和响应体分两次写出，关闭 Nagle 算法以免长连接上出现约 40ms 的延迟确认等待
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body=b"", headers=None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, obj):
+            self._send(200, json.dumps(obj, ensure_ascii=False).encode("utf-8"), {"Content-Type": "application/json"})
+
+        def _inject(self):
+            """记录请求，并按参数注入延迟和随机失败。返回 True 表示本次请求已以 500 结束。"""
+            with shared.lock:
+                shared.calls[self.path] += 1
+                fail = shared.rng.random() < shared.args.failure_rate
+            if shared.args.latency_ms:
+                time.sleep(shared.args.latency_ms / 1000.0)
+            if fail:
+                self._send(500, b"injected failure")
+            return fail
+
+        def do_GET(self):
+            if self._inject():
+                return
+            if serve_catalog:
+                if self.headers.get("If-None-Match") == '"bench-catalog"':
+                    return self._send(304)
+                return self._send(200, shared.catalog_body, {"Content-Type": "application/json", "ETag": '"bench-catalog"'})
+            if self.path == "/api/task/offline_download_transfer/done":
+                with shared.lock:
+                    done = list(shared.done)
+                return self._send_json({"code": 200, "data": done})
+            self._send(404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self._inject():
+                return
+            if self.path == "/api/auth/login":
+                return self._send_json({"code": 200, "data": {"token": "bench-token"}})
+            if self.path == "/api/fs/add_offline_download":
+                return self._send_json({"code": 200, "data": {"tasks": [shared.submit_download(url) for url in body.get("urls", [])]}})
+            if self.path == "/api/fs/list":
+                with shared.lock:
+                    content = list(shared.fs.get(body.get("path"), []))
+                return self._send_json({"code": 200, "data": {"content": content, "total": len(content)}})
+            if self.path == "/api/fs/rename":
+                ok = shared.rename(body.get("path", ""), body.get("name", ""))
+                return self._send_json({"code": 200 if ok else 500, "message": "success" if ok else "not found"})
+            self._send(404)
+
+    return Handler
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="使用本地模拟服务对 sbsubdown 的检查流程进行基准测试。")
+    parser.add_argument("--episodes", type=int, default=1200, help="模拟剧集目录中的剧集数量")
+    parser.add_argument("--start-episode", type=int, default=1150, help="状态文件中的起始集数，之后的剧集都会被视为新剧集")
+    parser.add_argument("--done", type=int, default=5000, help="已完成转存列表中预置的历史记录数量")
+    parser.add_argument("--filler", type=int, default=300, help="下载目录中无关文件的数量")
+    parser.add_argument("--filler-dirs", type=int, default=50, help="下载目录中无关子目录的数量")
+    parser.add_argument("--cycles", type=int, default=3, help="运行的完整检查轮数")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每个模拟请求注入的延迟 (毫秒)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="每个模拟请求返回 500 的概率")
+    parser.add_argument("--complete-fraction", type=float, default=0.5,
+                        help="每轮开始前完成的未完成离线下载比例 (至少一个)，使之后的轮次也需要匹配转存记录并整理文件")
+    parser.add_argument("--retry-max-delay", type=int, default=0,
+                        help="传给 sbsubdown 的 RETRY_MAX_DELAY_SECONDS；默认 0 即不等待重试退避，注入失败时的耗时不含退避时间")
+    parser.add_argument("--seed", type=int, default=0, help="随机失败的种子")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出结果")
+    parser.add_argument("--verbose", action="store_true", help="保留 sbsubdown 的 INFO 日志")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    shared = FakeServerState(args)
+    source_server = start_server(make_handler(shared, serve_catalog=True))
+    alist_server = start_server(make_handler(shared, serve_catalog=False))
+    work_dir = tempfile.mkdtemp(prefix="sbsubdown-bench-")
+
+    # main.py 在导入时读取环境变量，因此必须在导入之前完成配置
+    os.environ.update({
+        "ALIST_URL": f"http://127.0.0.1:{alist_server.server_port}",
+        "ALIST_USERNAME": "bench", "ALIST_PASSWORD": "bench", "ALIST_MOUNT_PATH": "/bench",
+        "DOWNLOAD_PATH": DOWNLOAD_PATH, "STATE_FILE_PATH": os.path.join(work_dir, "state.json"),
+        "START_EPISODE": str(args.start_episode), "RETRY_MAX_DELAY_SECONDS": str(args.retry_max_delay),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import main as sbsubdown
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    if args.json:
+        # main.py 的日志写到 stdout，JSON 模式下改写到 stderr，保证输出可直接解析
+        for handler in logging.getLogger().handlers:
+            handler.setStream(sys.stderr)
+    sbsubdown.catalog_cache.url = f"http://127.0.0.1:{source_server.server_port}/data/data.json"
+
+    scheduler = sbsubdown.UpdateScheduler(sbsubdown.AlistClient(os.environ["ALIST_URL"], "bench", "bench"))
+    tracemalloc.start()
+    results = []
+    for cycle in range(1, args.cycles + 1):
+        completed = shared.complete_outstanding(args.complete_fraction)
+        calls_before = collections.Counter(shared.calls)
+        sbsubdown.retry_budget.reset()
+        start = time.perf_counter()
+        scheduler.run_catalog_job()
+        phase_one = time.perf_counter() - start
+        scheduler.run_task_job(due_only=False)
+        wall = time.perf_counter() - start
+        state = sbsubdown.state_store.snapshot()
+        results.append({
+            "cycle": cycle, "wall_seconds": round(wall, 4), "phase_one_seconds": round(phase_one, 4), "phase_two_seconds": round(wall - phase_one, 4),
+            "completed_before_cycle": completed,
+            "http_calls": dict(shared.calls - calls_before), "pending_tasks": len(state["pending_tasks"]),
+            "last_completed_episode": state["last_completed_episode"],
+        })
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report = {
+        "parameters": vars(args), "cycles": results, "total_http_calls": dict(shared.calls),
+        "peak_traced_memory_mb": round(peak_traced / 1024 / 1024, 2),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "state_file_bytes": os.path.getsize(os.environ["STATE_FILE_PATH"]) if os.path.exists(os.environ["STATE_FILE_PATH"]) else 0,
+    }
+    source_server.shutdown(); alist_server.shutdown()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"剧集目录 {args.episodes} 集，起始集数 {args.start_episode}，已完成转存 {args.done} 条，注入延迟 {args.latency_ms} ms，失败率 {args.failure_rate}，"
+          f"每轮完成比例 {args.complete_fraction}，重试最大退避 {args.retry_max_delay}s")
+    for r in results:
+        calls = ", ".join(f"{path}={count}" for path, count in sorted(r["http_calls"].items()))
+        print(f"第 {r['cycle']} 轮: 总耗时 {r['wall_seconds']:.3f}s (阶段一 {r['phase_one_seconds']:.3f}s, 阶段二 {r['phase_two_seconds']:.3f}s)，"
+              f"本轮前完成下载 {r['completed_before_cycle']}，待处理 {r['pending_tasks']}，最后完成 {r['last_completed_episode']}，请求: {calls or '无'}")
+    print(f"请求总数: {sum(shared.calls.values())}，tracemalloc 峰值 {report['peak_traced_memory_mb']} MB，最大 RSS {report['max_rss_mb']} MB，状态文件 {report['state_file_bytes']} 字节")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import sys
 import time
 import threading
 import logging
 import functools
-from flask import Flask, render_template
+import collections
+import random
+import copy
+import contextlib
+import bisect
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template, request
+from waitress import serve
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 # --- 1. 配置模块 (已更新) ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stdout)
@@ -17,26 +28,159 @@ DOWNLOAD_PATH = os.getenv("DOWNLOAD_PATH")
 # 新增：必须设置你的 Alist 存储的根挂载路径，例如 "/al" 或 "/media"
 ALIST_MOUNT_PATH = os.getenv("ALIST_MOUNT_PATH")
 STATE_FILE_PATH = os.getenv("STATE_FILE_PATH", "/data/state.json")
+# 新增：剧集目录的本地缓存路径，默认与状态文件放在同一目录
+CATALOG_CACHE_PATH = os.getenv("CATALOG_CACHE_PATH", os.path.join(os.path.dirname(STATE_FILE_PATH), "catalog.json"))
 START_EPISODE = int(os.getenv("START_EPISODE", 0))
 IDLE_CHECK_INTERVAL_SECONDS = int(os.getenv("IDLE_CHECK_INTERVAL_SECONDS", 3600))
 ACTIVE_POLLING_INTERVAL_SECONDS = int(os.getenv("ACTIVE_POLLING_INTERVAL_SECONDS", 600))
+# 新增：待处理任务的最短检查间隔 (超过预计完成时间后从该间隔开始指数退避，最长为 ACTIVE_POLLING_INTERVAL_SECONDS)
+TASK_MIN_POLL_SECONDS = int(os.getenv("TASK_MIN_POLL_SECONDS", 60))
+# 新增：每周更新高峰窗口 (本地时间，星期一为 0)，窗口内按 CATALOG_PEAK_INTERVAL_SECONDS 更频繁地检查数据源
+CATALOG_PEAK_WEEKDAY = int(os.getenv("CATALOG_PEAK_WEEKDAY", 5))
+CATALOG_PEAK_START_HOUR = int(os.getenv("CATALOG_PEAK_START_HOUR", 18))
+CATALOG_PEAK_DURATION_HOURS = int(os.getenv("CATALOG_PEAK_DURATION_HOURS", 48))
+CATALOG_PEAK_INTERVAL_SECONDS = int(os.getenv("CATALOG_PEAK_INTERVAL_SECONDS", 600))
 ALIST_TOOL = os.getenv("ALIST_TOOL", "aria2")
 ALIST_DELETE_POLICY = os.getenv("ALIST_DELETE_POLICY", "delete_on_upload_succeed")
+# 新增：Alist token 的缓存时长，需小于 Alist 服务端设置的 token 有效期 (Alist 默认 48 小时)
+ALIST_TOKEN_TTL_SECONDS = int(os.getenv("ALIST_TOKEN_TTL_SECONDS", 86400))
+# 新增：每次请求打包提交的磁力链接数量 (设为 1 则关闭批量提交)，以及关闭批量提交时的并发提交数
+ALIST_SUBMIT_BATCH_SIZE = int(os.getenv("ALIST_SUBMIT_BATCH_SIZE", 20))
+ALIST_SUBMIT_CONCURRENCY = int(os.getenv("ALIST_SUBMIT_CONCURRENCY", 4))
+# 新增：下载目录快照的有效期，以及并行列出子目录的最大并发数
+DIR_SNAPSHOT_TTL_SECONDS = int(os.getenv("DIR_SNAPSHOT_TTL_SECONDS", 60))
+DIR_LIST_CONCURRENCY = int(os.getenv("DIR_LIST_CONCURRENCY", 4))
+# 新增：重试退避的最长等待时间、熔断器的打开阈值与持续时间、每轮调度的重试预算
+RETRY_MAX_DELAY_SECONDS = int(os.getenv("RETRY_MAX_DELAY_SECONDS", 30))
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5))
+CIRCUIT_BREAKER_RESET_SECONDS = int(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", 300))
+RETRY_BUDGET_PER_CYCLE = int(os.getenv("RETRY_BUDGET_PER_CYCLE", 10))
+# 新增：Web 服务器的工作线程数，以及 /api/events 推送流的保活间隔、同时订阅数上限、单个连接的最长持续时间和客户端重连间隔
+WEB_SERVER_THREADS = int(os.getenv("WEB_SERVER_THREADS", 8))
+SSE_KEEPALIVE_SECONDS = int(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+# 每个推送流占用一个工作线程，订阅数上限必须小于线程数，为页面、/api/status 和 /metrics 保留线程
+SSE_MAX_SUBSCRIBERS = max(0, min(int(os.getenv("SSE_MAX_SUBSCRIBERS", WEB_SERVER_THREADS // 2)), WEB_SERVER_THREADS - 1))
+SSE_STREAM_MAX_SECONDS = int(os.getenv("SSE_STREAM_MAX_SECONDS", 300))
+SSE_RETRY_SECONDS = int(os.getenv("SSE_RETRY_SECONDS", 5))
 MAX_RENAME_ATTEMPTS = 5
 DATA_URL = "https://cloud.sbsub.com/data/data.json"
+MAGNET_HASH_PATTERN = re.compile(r"urn:btih:([0-9a-zA-Z]+)")
+EPISODE_TAG_PATTERN = re.compile(r"\[SBSUB\]\[CONAN\]\[(\d+)\]")
+STATUS_EVENT_NAMES = {"added": "task_added", "completed": "task_completed", "failed": "task_given_up"}
 TRACKERS_TO_ADD = ("&tr=http://open.acgtracker.com:1096/announce" "&tr=http://tracker.cyber-gateway.net:6969/announce" "&tr=http://tracker.acgnx.se/announce" "&tr=http://share.camoe.cn:8080/announce" "&tr=http://t.acg.rip:6699/announce" "&tr=https://tr.bangumi.moe:9696/announce" "&tr=https://tracker.forever-legend.net:443/announce" "&tr=https://tracker.gbitt.info:443/announce" "&tr=https://tracker.lilithraws.org:443/announce" "&tr=https://tracker.moe.pm:443/announce")
 app = Flask(__name__)
 
-# --- 2. 通用重试装饰器 (无变化) ---
-def retry_on_failure(retries=3, delay=5, allowed_exceptions=(requests.exceptions.RequestException,)):
+# 新增：Prometheus 监控指标，通过 /metrics 导出
+ALIST_REQUEST_SECONDS = Histogram("sbsubdown_alist_request_seconds", "Alist API 请求耗时", ["call"])
+ALIST_REQUEST_ERRORS_TOTAL = Counter("sbsubdown_alist_request_errors_total", "Alist API 请求失败次数 (网络错误、HTTP 4xx/5xx 或响应中的 code 不为 200)", ["call"])
+SOURCE_FETCH_SECONDS = Histogram("sbsubdown_source_fetch_seconds", "数据源请求耗时")
+SOURCE_FETCH_ERRORS_TOTAL = Counter("sbsubdown_source_fetch_errors_total", "数据源请求失败次数")
+RETRIES_TOTAL = Counter("sbsubdown_retries_total", "retry_on_failure 发起的重试次数", ["function"])
+PHASE_DURATION_SECONDS = Histogram("sbsubdown_phase_duration_seconds", "阶段一 (检查新剧集) 与阶段二 (检查待处理任务) 的耗时", ["phase"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+PENDING_TASKS = Gauge("sbsubdown_pending_tasks", "待处理任务数量")
+SUBMIT_TO_RENAME_SECONDS = Histogram("sbsubdown_submit_to_rename_seconds", "从提交下载任务到确认重命名完成的耗时", buckets=(300, 600, 1800, 3600, 7200, 14400, 28800, 86400, 172800))
+
+# --- 2. 重试策略：指数退避 + 随机抖动、按端点熔断、每轮重试预算 ---
+class CircuitBreaker:
+    """
+    端点熔断器：连续失败达到阈值后打开，在 CIRCUIT_BREAKER_RESET_SECONDS 内直接拒绝调用 (快速失败)；
+    到期后进入半开状态，只放行一个试探调用 (其余调用继续快速失败)，试探成功则关闭，失败则再次打开。
+    """
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.failure_threshold = CIRCUIT_BREAKER_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.reset_timeout = CIRCUIT_BREAKER_RESET_SECONDS if reset_timeout is None else reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.failures < self.failure_threshold: return True
+            now = time.time()
+            if now < self.open_until: return False
+            # 半开状态：只放行当前这一个调用，并把打开期限向后推迟，直到它记录成功或失败之前其他调用 (如并行的列目录和提交) 都被拒绝；
+            # 试探调用没有记录结果 (例如非端点错误) 时，推迟的期限到期后会再放行下一个试探
+            self.open_until, self.probing = now + self.reset_timeout, True
+            return True
+
+    def record_success(self):
+        with self._lock: self.failures, self.open_until, self.probing = 0, 0.0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1; self.probing = False
+            if self.failures >= self.failure_threshold:
+                if self.failures == self.failure_threshold: logging.error(f"端点 '{self.name}' 连续失败 {self.failures} 次，熔断器打开 {self.reset_timeout} 秒。")
+                self.open_until = time.time() + self.reset_timeout
+
+    def retry_at(self):
+        """熔断器打开时返回允许下一次试探的时间戳，否则返回 0。"""
+        with self._lock: return self.open_until if self.failures >= self.failure_threshold else 0.0
+
+    def status(self):
+        with self._lock:
+            if self.failures < self.failure_threshold: state = "closed"
+            else: state = "open" if time.time() < self.open_until and not self.probing else "half_open"
+            return {"state": state, "consecutive_failures": self.failures, "open_until": self.open_until if state == "open" else None}
+
+class RetryBudget:
+    """每一轮调度可用的重试次数上限，防止端点故障时所有函数轮流重试导致整轮长时间停滞。"""
+    def __init__(self, size):
+        self.size = size
+        self.remaining = size
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock: self.remaining = self.size
+
+    def try_spend(self):
+        with self._lock:
+            if self.remaining <= 0: return False
+            self.remaining -= 1
+            return True
+
+circuit_breakers = {}
+retry_budget = RetryBudget(RETRY_BUDGET_PER_CYCLE)
+
+def get_circuit_breaker(endpoint):
+    return circuit_breakers.setdefault(endpoint, CircuitBreaker(endpoint))
+
+def retry_status():
+    """供调度器和 Web UI 使用的重试与熔断状态。"""
+    return {"breakers": {name: breaker.status() for name, breaker in circuit_breakers.items()},
+            "retry_budget": {"size": retry_budget.size, "remaining": retry_budget.remaining}}
+
+def _is_endpoint_failure(error):
+    """只有连接失败、超时和 5xx 才说明端点本身出了问题，其余错误 (如 4xx、响应格式错误) 不计入熔断。"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)): return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and response.status_code >= 500
+
+def retry_on_failure(endpoint, retries=3, delay=5, allowed_exceptions=(requests.exceptions.RequestException,)):
+    """
+    失败时重试被装饰的函数，最终失败或被熔断时返回 None。
+    第 i 次重试前等待 [0, min(RETRY_MAX_DELAY_SECONDS, delay * 2^(i-1))] 内的随机时间，
+    并消耗一次本轮的重试预算；预算用尽时不再重试。
+    """
+    breaker = get_circuit_breaker(endpoint)
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             for i in range(1, retries + 1):
-                try: return func(*args, **kwargs)
+                if not breaker.allow():
+                    logging.warning(f"端点 '{endpoint}' 的熔断器处于打开状态，跳过函数 '{func.__name__}' 的调用。"); return None
+                try:
+                    result = func(*args, **kwargs)
+                    breaker.record_success(); return result
                 except allowed_exceptions as e:
+                    if _is_endpoint_failure(e): breaker.record_failure()
                     if i == retries: logging.error(f"函数 '{func.__name__}' 在 {retries} 次尝试后最终失败。错误: {e}"); return None
-                    logging.warning(f"函数 '{func.__name__}' 失败 (第 {i}/{retries} 次尝试)。将在 {delay} 秒后重试... 错误: {e}"); time.sleep(delay)
+                    if not retry_budget.try_spend(): logging.error(f"本轮的重试预算已用尽，函数 '{func.__name__}' 不再重试。错误: {e}"); return None
+                    RETRIES_TOTAL.labels(function=func.__name__).inc()
+                    wait = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, delay * 2 ** (i - 1)))
+                    logging.warning(f"函数 '{func.__name__}' 失败 (第 {i}/{retries} 次尝试)。将在 {wait:.1f} 秒后重试... 错误: {e}"); time.sleep(wait)
         return wrapper
     return decorator
 
@@ -46,255 +190,794 @@ def check_env_vars():
     if not all([ALIST_URL, ALIST_USERNAME, ALIST_PASSWORD, DOWNLOAD_PATH, STATE_FILE_PATH, ALIST_MOUNT_PATH]):
         logging.error("环境变量 ALIST_URL, ALIST_USERNAME, ALIST_PASSWORD, DOWNLOAD_PATH, STATE_FILE_PATH, ALIST_MOUNT_PATH 必须全部设置。"); sys.exit(1)
 
-@retry_on_failure(retries=3, delay=3)
-def _get_task_list_from_v4_api(token, endpoint_url):
-    headers = {"Authorization": token}
-    try:
-        response = requests.get(endpoint_url, headers=headers, timeout=10)
-        response.raise_for_status()
-        if not response.text: logging.error(f"从 {endpoint_url} 收到的响应为空。"); return []
-        return response.json().get("data", [])
-    except json.JSONDecodeError:
-        logging.error(f"解析 Alist 任务列表失败！URL: {endpoint_url}"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
-
-def get_completed_transfer_tasks(token):
-    logging.info("正在检查已完成的转存任务列表...")
-    transfer_done_url = f"{ALIST_URL}/api/task/offline_download_transfer/done"
-    tasks = _get_task_list_from_v4_api(token, transfer_done_url)
-    if tasks is not None:
-        logging.info(f"成功获取到 {len(tasks)} 个已完成的转存任务。")
-    return tasks
-
-@retry_on_failure(retries=3, delay=5)
-def get_alist_token():
-    login_url = f"{ALIST_URL}/api/auth/login"; payload = {"username": ALIST_USERNAME, "password": ALIST_PASSWORD}
-    try: response = requests.post(login_url, json=payload, timeout=10); response.raise_for_status(); return response.json()["data"]["token"]
-    except json.JSONDecodeError: logging.error(f"解析 Alist token 失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
-
-@retry_on_failure(retries=3, delay=3)
-def add_offline_download(token, magnet_link):
-    download_url = f"{ALIST_URL}/api/fs/add_offline_download"; headers = {"Authorization": token}; payload = {"path": DOWNLOAD_PATH, "urls": [magnet_link], "tool": ALIST_TOOL, "delete_policy": ALIST_DELETE_POLICY}
-    try:
-        response = requests.post(download_url, headers=headers, json=payload, timeout=10); response.raise_for_status(); response_data = response.json(); task_id = response_data.get("data", {}).get("tasks", [{}])[0].get("id")
-        if task_id: logging.info(f"成功将任务添加到 Alist 目录 '{DOWNLOAD_PATH}'，任务ID: {task_id}"); return task_id
-        logging.warning(f"添加下载任务成功，但响应中未找到任务 ID。响应: {response.text}"); return None
-    except json.JSONDecodeError: logging.error(f"解析 Alist 添加任务响应失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
-
-@retry_on_failure(retries=3, delay=2)
-def list_files(token, path):
-    list_url = f"{ALIST_URL}/api/fs/list"; headers = {"Authorization": token}; payload = {"path": path, "page": 1, "per_page": 0}
-    try:
-        response = requests.post(list_url, headers=headers, json=payload, timeout=15); response.raise_for_status()
-        if not response.text: logging.error(f"从 {list_url} (路径: {path}) 收到的响应为空。"); return None
-        response_data = response.json()
-        if response_data.get("code") == 200: return response_data.get("data", {}).get("content", [])
-        logging.error(f"列出目录 '{path}' 文件失败。服务器响应: {response.text}"); return None
-    except json.JSONDecodeError: logging.error(f"解析 Alist 目录列表失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
-
-# 更新：最关键的修复，重写 rename_file 函数
-# 更新：最终修正版，根据用户成功的 API 请求重构 rename_file 函数
-@retry_on_failure(retries=3, delay=2)
-def rename_file(token, src_directory, original_name, new_name):
+def magnet_hash(text):
+    """提取磁力链接 (或包含磁力链接的任务名称) 中的 btih 哈希，统一为小写。"""
+    match = MAGNET_HASH_PATTERN.search(text)
+    return match.group(1).lower() if match else None
+
+class AlistClient:
     """
-    最终修正版重命名函数：
-    使用 'path' 和 'name' 字段来构建请求体，以匹配当前 Alist API 的要求。
+    Alist API 客户端：
+    - 所有请求共用一个 requests.Session，底层连接池保持长连接，避免每次调用都重新进行 TCP/TLS 握手；
+    - 登录得到的 token 会被缓存，在过期前重复使用，不再每个循环都重新登录；
+    - 如果服务器提示 token 已失效 (401)，会自动重新登录并重发一次请求。
     """
-    # 步骤 1: 构建 Alist API 需要的 'path' 字段，即源文件的完整路径
-    # os.path.join 能够智能地处理路径拼接
-    full_original_path = os.path.join(src_directory, original_name)
-
-    # 步骤 2: 构建新的、正确的请求体 (payload)
-    payload = {
-        "path": full_original_path,
-        "name": new_name
-    }
-
-    rename_url = f"{ALIST_URL}/api/fs/rename"
-    # requests 库在使用 json=... 参数时，会自动设置 Content-Type 为 application/json
-    # 并且正确处理 UTF-8 编码，所以我们无需手动设置 headers
-    headers = {"Authorization": token}
-    
-    try:
-        # 更新日志，打印出我们最终发送的、格式正确的载荷
-        logging.info(f"正在发送【新格式】重命名请求到 Alist，载荷: {json.dumps(payload, ensure_ascii=False)}")
-        
-        response = requests.post(rename_url, headers=headers, json=payload, timeout=10)
-        response.raise_for_status()
-        response_data = response.json()
-        if response_data.get("code") == 200:
-            logging.info(f"成功将 '{original_name}' 重命名为 '{new_name}'")
-            return True
-        
-        logging.error(f"重命名文件 '{original_name}' 失败。服务器响应: {response.text}")
-        return False
-    except json.JSONDecodeError:
-        logging.error(f"解析 Alist 重命名响应失败！")
-        logging.error(f"服务器状态码: {response.status_code}")
-        logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}")
-        raise
-
-def load_state():
-    if os.path.exists(STATE_FILE_PATH):
+    def __init__(self, base_url, username, password, token_ttl=ALIST_TOKEN_TTL_SECONDS, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.token_ttl = token_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter); self.session.mount("https://", adapter)
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        # 批量提交结果不确定的磁力链接哈希，重新提交前需先在 Alist 任务列表中确认
+        self.unconfirmed_magnet_hashes = set()
+
+    @retry_on_failure("alist", retries=3, delay=5)
+    def _login(self):
+        login_url = f"{self.base_url}/api/auth/login"; payload = {"username": self.username, "password": self.password}
+        try: response = self._send("POST", login_url, "login", json=payload, timeout=10); response.raise_for_status(); return self._check_code("login", response.json())["data"]["token"]
+        except json.JSONDecodeError: logging.error(f"解析 Alist token 失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
+
+    def get_token(self, stale_token=None):
+        """返回缓存的 token；缓存为空、已过期或与 stale_token 相同 (即已被服务器拒绝) 时重新登录。"""
+        with self._token_lock:
+            if self._token and self._token != stale_token and time.time() < self._token_expires_at:
+                return self._token
+            logging.info("正在登录 Alist 获取新的 token...")
+            token = self._login()
+            self._token, self._token_expires_at = token, (time.time() + self.token_ttl if token else 0.0)
+            return token
+
+    @staticmethod
+    def _check_code(call, response_data):
+        """Alist 以 HTTP 200 + 非 200 的 code 报告接口错误，这类失败同样计入错误次数。原样返回 response_data。"""
+        if isinstance(response_data, dict) and response_data.get("code", 200) != 200: ALIST_REQUEST_ERRORS_TOTAL.labels(call=call).inc()
+        return response_data
+
+    @staticmethod
+    def _is_unauthorized(response):
+        if response.status_code == 401: return True
+        # Alist 的鉴权错误通常以 HTTP 200 + {"code": 401} 的形式返回；错误响应体都很短，只检查短响应以免重复解析大列表
+        if len(response.content) > 512: return False
+        try: return response.json().get("code") == 401
+        except (ValueError, AttributeError): return False
+
+    def _send(self, method, url, call, **kwargs):
+        """发送一次 HTTP 请求，并按调用名称记录耗时与错误次数。"""
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            ALIST_REQUEST_ERRORS_TOTAL.labels(call=call).inc(); raise
+        finally:
+            ALIST_REQUEST_SECONDS.labels(call=call).observe(time.perf_counter() - start)
+        if response.status_code >= 400: ALIST_REQUEST_ERRORS_TOTAL.labels(call=call).inc()
+        return response
+
+    def _request(self, method, path, **kwargs):
+        call = path[len("/api/"):] if path.startswith("/api/") else path
+        token = self.get_token()
+        if not token: raise requests.exceptions.RequestException("无法获取 Alist token")
+        response = self._send(method, f"{self.base_url}{path}", call, headers={"Authorization": token}, **kwargs)
+        if self._is_unauthorized(response):
+            if response.status_code < 400: ALIST_REQUEST_ERRORS_TOTAL.labels(call=call).inc()
+            logging.warning("Alist token 已失效，正在重新登录后重试请求...")
+            token = self.get_token(stale_token=token)
+            if not token: raise requests.exceptions.RequestException("重新登录 Alist 失败")
+            response = self._send(method, f"{self.base_url}{path}", call, headers={"Authorization": token}, **kwargs)
+        return response
+
+    @retry_on_failure("alist", retries=3, delay=3)
+    def _get_task_list_from_v4_api(self, endpoint_path):
         try:
-            with open(STATE_FILE_PATH, 'r') as f: return json.load(f)
-        except (IOError, json.JSONDecodeError) as e: logging.warning(f"读取或解析状态文件失败: {e}。将使用默认状态。")
-    return {"last_completed_episode": float(START_EPISODE), "pending_tasks": []}
+            response = self._request("GET", endpoint_path, timeout=10)
+            response.raise_for_status()
+            if not response.text: logging.error(f"从 {endpoint_path} 收到的响应为空。"); return []
+            return self._check_code(endpoint_path[len("/api/"):], response.json()).get("data") or []
+        except json.JSONDecodeError:
+            logging.error(f"解析 Alist 任务列表失败！URL: {endpoint_path}"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
 
-# 更新：修复了 IndentationError
-def save_state(state):
+    def find_offline_download_tasks(self, hashes):
+        """在 Alist 的离线下载任务列表中查找这些磁力链接哈希对应的任务，返回 {哈希: 任务ID}；列表获取失败时返回 None。"""
+        found = {}
+        for endpoint_path in ("/api/task/offline_download/undone", "/api/task/offline_download/done"):
+            tasks = self._get_task_list_from_v4_api(endpoint_path)
+            if tasks is None: return None
+            for task in tasks:
+                task_hash = magnet_hash(str(task.get("name", "")))
+                if task_hash in hashes: found.setdefault(task_hash, task.get("id"))
+        return found
+
+    def get_completed_transfer_tasks(self):
+        logging.info("正在检查已完成的转存任务列表...")
+        tasks = self._get_task_list_from_v4_api("/api/task/offline_download_transfer/done")
+        if tasks is not None:
+            logging.info(f"成功获取到 {len(tasks)} 个已完成的转存任务。")
+        return tasks
+
+    @retry_on_failure("alist", retries=3, delay=3)
+    def add_offline_download(self, magnet_link):
+        payload = {"path": DOWNLOAD_PATH, "urls": [magnet_link], "tool": ALIST_TOOL, "delete_policy": ALIST_DELETE_POLICY}
+        try:
+            response = self._request("POST", "/api/fs/add_offline_download", json=payload, timeout=10); response.raise_for_status(); response_data = self._check_code("fs/add_offline_download", response.json()); task_id = response_data.get("data", {}).get("tasks", [{}])[0].get("id")
+            if task_id: logging.info(f"成功将任务添加到 Alist 目录 '{DOWNLOAD_PATH}'，任务ID: {task_id}"); return task_id
+            logging.warning(f"添加下载任务成功，但响应中未找到任务 ID。响应: {response.text}"); return None
+        except json.JSONDecodeError: logging.error(f"解析 Alist 添加任务响应失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
+
+    @staticmethod
+    def _match_tasks_to_urls(urls, tasks):
+        """根据磁力链接的 btih 哈希把返回的任务对应回提交的链接；剩余的任务在数量一致时按提交顺序对应。"""
+        task_ids, unmatched = [None] * len(urls), []
+        hashes = [magnet_hash(url) for url in urls]
+        for task in tasks:
+            name = str(task.get("name", "")).lower()
+            index = next((i for i, h in enumerate(hashes) if h and task_ids[i] is None and h in name), None)
+            if index is None: unmatched.append(task)
+            else: task_ids[index] = task.get("id")
+        if len(tasks) == len(urls):
+            free_slots = [i for i, task_id in enumerate(task_ids) if task_id is None]
+            for i, task in zip(free_slots, unmatched): task_ids[i] = task.get("id")
+        return task_ids
+
+    # 批量提交不自动重试：超时或 5xx 时 Alist 可能已经接受了请求，整批重发会产生重复的下载任务
+    @retry_on_failure("alist", retries=1)
+    def add_offline_downloads(self, magnet_links):
+        """在一次请求中提交多个磁力链接，返回与 magnet_links 一一对应的任务 ID 列表 (无法对应的为 None)。"""
+        payload = {"path": DOWNLOAD_PATH, "urls": list(magnet_links), "tool": ALIST_TOOL, "delete_policy": ALIST_DELETE_POLICY}
+        try:
+            response = self._request("POST", "/api/fs/add_offline_download", json=payload, timeout=30); response.raise_for_status(); response_data = self._check_code("fs/add_offline_download", response.json())
+            tasks = (response_data.get("data") or {}).get("tasks") or []
+            if not tasks: logging.warning(f"批量添加下载任务后，响应中未找到任何任务。响应: {response.text[:500]}"); return None
+            task_ids = self._match_tasks_to_urls(payload["urls"], tasks)
+            logging.info(f"成功批量添加 {len(payload['urls'])} 个任务到 Alist 目录 '{DOWNLOAD_PATH}'，其中 {sum(1 for t in task_ids if t)} 个已对应到任务ID。")
+            return task_ids
+        except json.JSONDecodeError: logging.error(f"解析 Alist 批量添加任务响应失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
+
+    @retry_on_failure("alist", retries=3, delay=2)
+    def list_files(self, path):
+        payload = {"path": path, "page": 1, "per_page": 0}
+        try:
+            response = self._request("POST", "/api/fs/list", json=payload, timeout=15); response.raise_for_status()
+            if not response.text: logging.error(f"从 /api/fs/list (路径: {path}) 收到的响应为空。"); return None
+            response_data = self._check_code("fs/list", response.json())
+            if response_data.get("code") == 200: return response_data.get("data", {}).get("content", [])
+            logging.error(f"列出目录 '{path}' 文件失败。服务器响应: {response.text}"); return None
+        except json.JSONDecodeError: logging.error(f"解析 Alist 目录列表失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
+
+    # 更新：最终修正版，根据用户成功的 API 请求重构 rename_file 函数
+    @retry_on_failure("alist", retries=3, delay=2)
+    def rename_file(self, src_directory, original_name, new_name):
+        """
+        最终修正版重命名函数：
+        使用 'path' 和 'name' 字段来构建请求体，以匹配当前 Alist API 的要求。
+        """
+        # 步骤 1: 构建 Alist API 需要的 'path' 字段，即源文件的完整路径
+        # os.path.join 能够智能地处理路径拼接
+        full_original_path = os.path.join(src_directory, original_name)
+
+        # 步骤 2: 构建新的、正确的请求体 (payload)
+        payload = {
+            "path": full_original_path,
+            "name": new_name
+        }
+
+        try:
+            # 更新日志，打印出我们最终发送的、格式正确的载荷
+            logging.info(f"正在发送【新格式】重命名请求到 Alist，载荷: {json.dumps(payload, ensure_ascii=False)}")
+
+            # requests 库在使用 json=... 参数时，会自动设置 Content-Type 为 application/json
+            # 并且正确处理 UTF-8 编码；Authorization 头由 _request 统一添加
+            response = self._request("POST", "/api/fs/rename", json=payload, timeout=10)
+            response.raise_for_status()
+            response_data = self._check_code("fs/rename", response.json())
+            if response_data.get("code") == 200:
+                logging.info(f"成功将 '{original_name}' 重命名为 '{new_name}'")
+                return True
+
+            logging.error(f"重命名文件 '{original_name}' 失败。服务器响应: {response.text}")
+            return False
+        except json.JSONDecodeError:
+            logging.error(f"解析 Alist 重命名响应失败！")
+            logging.error(f"服务器状态码: {response.status_code}")
+            logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}")
+            raise
+
+class StateStore:
+    """
+    状态存储：
+    状态常驻内存并由锁保护，读者 (如 Web UI) 通过 snapshot() 或只复制所需部分的 pending_tasks() 等方法获取副本而无需读取磁盘；
+    修改通过 transaction() 进行，先写入临时文件再原子地 rename 覆盖状态文件，写入中途崩溃不会损坏原文件。
+    每次提交都会递增版本号，并唤醒等待状态变化的读者 (如 /api/events 的推送流)。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._state = self._load()
+        # 进程启动标识与版本号共同组成 ETag，避免重启后版本号重新计数导致客户端缓存误判
+        self.boot_id = f"{int(time.time()):x}"
+        self.version = 0
+        self._events = collections.deque(maxlen=200)
+        self._status_cache = None
+
+    def _load(self):
+        state = {"last_completed_episode": float(START_EPISODE), "pending_tasks": [], "history": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f: state.update(json.load(f))
+            except (IOError, json.JSONDecodeError) as e: logging.warning(f"读取或解析状态文件失败: {e}。将使用默认状态。")
+        return state
+
+    def _persist(self, state):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False, separators=(",", ":")); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"无法写入状态文件 '{self.path}': {e}")
+            sys.exit(1)
+
+    def snapshot(self):
+        """完整状态的深拷贝 (包含不断增长的 history)，只在需要整个状态的地方使用。"""
+        with self._lock: return copy.deepcopy(self._state)
+
+    def pending_tasks(self):
+        """只复制待处理任务列表，供频繁读取的页面和调度循环使用。"""
+        with self._lock: return copy.deepcopy(self._state.get("pending_tasks", []))
+
+    def pending_count(self):
+        with self._lock: return len(self._state.get("pending_tasks", []))
+
+    def last_completed_episode(self):
+        with self._lock: return self._state.get("last_completed_episode")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """在副本上修改状态；代码块正常结束时持久化并替换内存中的状态，抛出异常时丢弃修改。"""
+        with self._lock:
+            working = copy.deepcopy(self._state)
+            yield working
+            self._persist(working)
+            previous_history, self._state = self._state.get("history", {}), working
+            self.version += 1
+            self._record_events(previous_history, working.get("history", {}))
+            self._changed.notify_all()
+
+    def _record_events(self, previous_history, history):
+        """对比提交前后的 history，把新出现的 added / completed / failed 记录为推送事件。"""
+        for episode, events in history.items():
+            previous_events = previous_history.get(episode, {})
+            for event, at in events.items():
+                if event in STATUS_EVENT_NAMES and previous_events.get(event) != at:
+                    self._events.append({"version": self.version, "event": STATUS_EVENT_NAMES.get(event, event), "episode_number": float(episode), "at": at})
+
+    def status_snapshot(self):
+        """返回 (版本号, etag, JSON 字节)，三者在同一次加锁中读取。同一版本只序列化一次，之后的请求直接复用缓存。"""
+        with self._lock:
+            if self._status_cache is None or self._status_cache[0] != self.version:
+                status = {"version": self.version, "last_completed_episode": self._state.get("last_completed_episode"),
+                          "pending_tasks": self._state.get("pending_tasks", []), "recent_events": list(self._events)[-20:]}
+                body = json.dumps(status, ensure_ascii=False).encode("utf-8")
+                self._status_cache = (self.version, f"{self.boot_id}-{self.version}", body)
+            return self._status_cache
+
+    def wait_for_change(self, version, timeout):
+        """等待版本号超过 version，返回 ((新版本号, etag, JSON 字节), 期间产生的事件)；超时返回 None。
+        状态与事件在同一次加锁中读取，事件恰好覆盖 version 之后到新版本号为止的变化。"""
+        with self._changed:
+            if not self._changed.wait_for(lambda: self.version != version, timeout=timeout): return None
+            return self.status_snapshot(), [e for e in self._events if e["version"] > version]
+
+def record_episode_event(state, episode_number, event):
+    """在状态的 history 中记录剧集 added / completed / failed 的时间戳。"""
+    state.setdefault("history", {}).setdefault(str(episode_number), {})[event] = time.time()
+
+state_store = StateStore(STATE_FILE_PATH)
+PENDING_TASKS.set_function(state_store.pending_count)
+
+@retry_on_failure("sbsub", retries=3, delay=10)
+def fetch_data_from_source(url, headers=None):
+    """请求数据源，返回 (response, data)。数据源返回 304 (未变化) 时 data 为 None。"""
     try:
-        os.makedirs(os.path.dirname(STATE_FILE_PATH), exist_ok=True)
-        with open(STATE_FILE_PATH, 'w') as f:
-            json.dump(state, f, indent=2)
-    except IOError as e:
-        logging.error(f"无法写入状态文件 '{STATE_FILE_PATH}': {e}")
-        sys.exit(1)
-
-@retry_on_failure(retries=3, delay=10)
-def fetch_data_from_source(url):
-    try: response = requests.get(url, timeout=15); response.raise_for_status(); return response.json()
+        with SOURCE_FETCH_SECONDS.time():
+            try: response = requests.get(url, headers=headers, timeout=15); response.raise_for_status()
+            except requests.exceptions.RequestException: SOURCE_FETCH_ERRORS_TOTAL.inc(); raise
+        if response.status_code == 304: return response, None
+        return response, response.json()
     except json.JSONDecodeError: logging.error(f"解析数据源 {url} 失败！"); logging.error(f"服务器状态码: {response.status_code}"); logging.error(f"服务器原始响应 (前500字符): {response.text[:500]}"); raise
 
-def find_new_episodes(last_completed_episode):
-    logging.info("正在从数据源获取最新剧集列表..."); data = fetch_data_from_source(DATA_URL)
-    if not data: logging.error("获取数据失败，已跳过本次剧集检查。"); return []
-    tv_shows = data.get("res", [])[0][4]; new_episodes = []
-    for episode_num_str, value in tv_shows.items():
-        if "（本集未被日本官网计入总集数）" in value[1]: continue
+class CatalogCache:
+    """
+    sbsub 剧集目录的本地缓存：
+    - 使用 ETag / If-Modified-Since 发送条件请求，数据源未变化 (304) 时跳过下载和解析；
+    - 在磁盘上保留一份目录副本，重启后无需重新下载即可继续发送条件请求；
+    - 维护按集数排序的索引，新剧集通过二分查找获得，而不是每次全量扫描。
+    """
+    def __init__(self, url, cache_path):
+        self.url = url
+        self.cache_path = cache_path
+        self.etag = None
+        self.last_modified = None
+        self.episodes = {}
+        self.episode_numbers = []
+        self._load_from_disk()
+
+    def _build_index(self, tv_shows):
+        episodes = {}
+        for episode_num_str, value in tv_shows.items():
+            if "（本集未被日本官网计入总集数）" in value[1]: continue
+            try: episodes[float(episode_num_str)] = value
+            except ValueError: logging.warning(f"无法解析集数 '{episode_num_str}'，已跳过。")
+        self.episodes = episodes
+        self.episode_numbers = sorted(episodes)
+
+    def _load_from_disk(self):
+        if not os.path.exists(self.cache_path): return
         try:
-            if float(episode_num_str) > last_completed_episode: new_episodes.append((float(episode_num_str), value))
-        except ValueError: logging.warning(f"无法解析集数 '{episode_num_str}'，已跳过。")
-    new_episodes.sort(key=lambda x: x[0]); return new_episodes
+            with open(self.cache_path, 'r', encoding='utf-8') as f: cached = json.load(f)
+            self._build_index(cached["tv_shows"])
+            self.etag, self.last_modified = cached.get("etag"), cached.get("last_modified")
+            logging.info(f"已从 '{self.cache_path}' 载入缓存的剧集目录，共 {len(self.episode_numbers)} 集。")
+        except (IOError, KeyError, TypeError, AttributeError, json.JSONDecodeError) as e:
+            logging.warning(f"读取剧集目录缓存失败: {e}。将重新从数据源获取。")
+            self.etag, self.last_modified, self.episodes, self.episode_numbers = None, None, {}, []
 
-# --- 4. 主工作循环 (逻辑已重构, 日志已增强) ---
-def run_update_checker():
-    logging.info("更新检查器线程已启动...")
-    while True:
-        logging.info("-" * 30); state = load_state()
+    def _save_to_disk(self, tv_shows):
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"etag": self.etag, "last_modified": self.last_modified, "tv_shows": tv_shows}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except IOError as e:
+            logging.warning(f"无法写入剧集目录缓存 '{self.cache_path}': {e}")
+
+    def refresh(self):
+        """向数据源发送条件请求并在有变化时重建索引。返回是否成功拿到可用的目录。"""
+        headers = {}
+        if self.episode_numbers:
+            if self.etag: headers["If-None-Match"] = self.etag
+            if self.last_modified: headers["If-Modified-Since"] = self.last_modified
+        result = fetch_data_from_source(self.url, headers=headers)
+        if not result: return False
+        response, data = result
+        if response.status_code == 304:
+            logging.info("数据源未发生变化 (304)，沿用本地缓存的剧集目录。"); return True
+        try: tv_shows = data.get("res", [])[0][4]
+        except (IndexError, KeyError, TypeError, AttributeError):
+            logging.error("数据源返回的数据格式无法识别，已忽略本次结果。"); return False
+        self._build_index(tv_shows)
+        self.etag, self.last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        self._save_to_disk(tv_shows)
+        logging.info(f"剧集目录已更新，共 {len(self.episode_numbers)} 集。")
+        return True
+
+    def episodes_after(self, last_completed_episode):
+        start = bisect.bisect_right(self.episode_numbers, last_completed_episode)
+        return [(num, self.episodes[num]) for num in self.episode_numbers[start:]]
+
+catalog_cache = CatalogCache(DATA_URL, CATALOG_CACHE_PATH)
+
+def find_new_episodes(last_completed_episode):
+    logging.info("正在从数据源获取最新剧集列表...")
+    if not catalog_cache.refresh():
+        if not catalog_cache.episode_numbers: logging.error("获取数据失败，已跳过本次剧集检查。"); return []
+        logging.warning("获取数据失败，将使用本地缓存的剧集目录进行检查。")
+    return catalog_cache.episodes_after(last_completed_episode)
+
+def build_download_requests(new_episodes, pending_tasks):
+    """为尚未在待处理列表中的新剧集挑选 '简繁日MKV' 磁力链接，生成待提交的下载请求。"""
+    pending_episodes = {p.get('episode_number') for p in pending_tasks}
+    download_requests = []
+    for episode_num, episode_info in new_episodes:
+        if episode_num in pending_episodes: logging.info(f"剧集 {episode_num} 已在待处理列表中，跳过添加。"); continue
+        magnet = next((item[2] for item in episode_info[7].get("WEBRIP", []) if len(item) > 2 and item[1] == "简繁日MKV"), None)
+        if not magnet: logging.warning(f"在剧集 {episode_num} 中未找到 '简繁日MKV' 格式的下载链接。"); continue
+        download_requests.append({"episode_number": episode_num, "magnet": magnet + "".join(TRACKERS_TO_ADD), "desired_filename": f"{episode_info[0]} {episode_info[1]}.mkv"})
+    return download_requests
+
+def submit_download_requests(alist, download_requests):
+    """
+    提交下载请求，返回与 download_requests 一一对应的任务 ID 列表 (失败为 None)。
+    ALIST_SUBMIT_BATCH_SIZE > 1 时每次请求打包多个磁力链接；否则以 ALIST_SUBMIT_CONCURRENCY 的并发度逐个提交。
+    批量提交结果不确定 (请求失败或任务无法对应) 的磁力链接会被记下，下次提交前先在 Alist 的离线下载任务列表中查找，避免重复提交。
+    """
+    task_ids = [None] * len(download_requests)
+    hashes = [magnet_hash(r["magnet"]) for r in download_requests]
+    unconfirmed = {h for h in hashes if h in alist.unconfirmed_magnet_hashes}
+    if unconfirmed:
+        existing = alist.find_offline_download_tasks(unconfirmed)
+        if existing is None: logging.warning(f"无法获取 Alist 离线下载任务列表，{len(unconfirmed)} 个上次提交结果不确定的剧集将推迟到下次检查。")
+        else:
+            alist.unconfirmed_magnet_hashes -= unconfirmed
+            for i, h in enumerate(hashes):
+                if h in existing: task_ids[i] = existing[h]; logging.info(f"剧集 {download_requests[i]['episode_number']} 已在 Alist 中找到之前提交的任务 (任务ID: {existing[h]})，不再重复提交。")
+    to_submit = [i for i, h in enumerate(hashes) if task_ids[i] is None and h not in alist.unconfirmed_magnet_hashes]
+    if ALIST_SUBMIT_BATCH_SIZE > 1:
+        for start in range(0, len(to_submit), ALIST_SUBMIT_BATCH_SIZE):
+            batch = to_submit[start:start + ALIST_SUBMIT_BATCH_SIZE]
+            batch_ids = alist.add_offline_downloads([download_requests[i]["magnet"] for i in batch]) or [None] * len(batch)
+            for i, task_id in zip(batch, batch_ids):
+                task_ids[i] = task_id
+                if task_id is None and hashes[i]: alist.unconfirmed_magnet_hashes.add(hashes[i])
+        return task_ids
+    with ThreadPoolExecutor(max_workers=max(1, ALIST_SUBMIT_CONCURRENCY)) as pool:
+        for i, task_id in zip(to_submit, pool.map(lambda i: alist.add_offline_download(download_requests[i]["magnet"]), to_submit)): task_ids[i] = task_id
+    return task_ids
+
+def _parse_alist_time(value):
+    """解析 Alist 任务中的 ISO 8601 时间 (如 end_time)，无法解析或为零值时返回 None。"""
+    if not isinstance(value, str) or not value: return None
+    value = re.sub(r"(\.\d{6})\d+", r"\1", value.replace("Z", "+00:00"))
+    try: parsed = datetime.datetime.fromisoformat(value)
+    except ValueError: return None
+    return parsed.timestamp() if parsed.year >= 2000 and parsed.tzinfo else None
+
+class TransferIndex:
+    """
+    已完成转存任务的索引：
+    从每个转存任务名称中解析一次 [SBSUB][CONAN][NNNN] 集数，建立 集数 -> 任务名称 的字典，
+    并记录已处理过的任务 ID，之后的轮询只解析上次以来新出现的任务。
+    """
+    def __init__(self):
+        self.seen_ids = set()
+        self.by_episode = {}
+        self.finished_at = {}
+
+    def update(self, transfers):
+        """合并最新的已完成转存列表，返回其中新出现的任务数量。"""
+        current_ids, new_count = set(), 0
+        for transfer in transfers:
+            name = transfer.get('name', '')
+            transfer_id = transfer.get('id') or name
+            current_ids.add(transfer_id)
+            if transfer_id in self.seen_ids: continue
+            new_count += 1
+            match = EPISODE_TAG_PATTERN.search(name)
+            if match and '.mkv' in name and match.group(1) not in self.by_episode:
+                self.by_episode[match.group(1)] = name; logging.info(f"新的已完成转存任务: '{name}'")
+                finished_at = _parse_alist_time(transfer.get('end_time'))
+                if finished_at: self.finished_at[match.group(1)] = finished_at
+        # 只保留 Alist 当前列表中仍存在的 ID，已被清理的任务不会让集合无限增长
+        self.seen_ids = current_ids
+        return new_count
+
+    def lookup(self, episode_num_str):
+        return self.by_episode.get(episode_num_str)
+
+class DirectorySnapshot:
+    """
+    下载目录的快照，在有效期 (DIR_SNAPSHOT_TTL_SECONDS) 内被同一轮的所有任务共享：
+    主目录只列出一次，名称中包含目标集数的子目录并行列出，
+    所有以 [SBSUB][CONAN][NNNN] 开头的 .mkv 文件按集数建立索引。重命名成功后会同步修正索引。
+    """
+    def __init__(self, alist, root, ttl=None):
+        self.alist = alist
+        self.root = root
+        self.ttl = DIR_SNAPSHOT_TTL_SECONDS if ttl is None else ttl
+        self.root_entries = None
+        self.taken_at = 0.0
+        self.listed_dirs = set()
+        self.files = {}
+
+    def _index_entries(self, directory, entries):
+        for item in entries:
+            name = item.get("name", "")
+            if item.get("is_dir") or not name.endswith(".mkv"): continue
+            match = EPISODE_TAG_PATTERN.match(name)
+            if match: self.files.setdefault(match.group(1), (directory, name))
+
+    def refresh(self, episode_num_strs):
+        """
+        确保快照仍在有效期内，并且名称中包含这些集数的子目录都已列出。
+        复用的旧快照中缺少某个集数时 (文件可能在快照之后才出现)，丢弃快照并重新列出一次。
+        """
+        reused = self.root_entries is not None and time.time() - self.taken_at <= self.ttl
+        if not self._ensure(episode_num_strs, reuse=reused): return False
+        if reused and any(ep not in self.files for ep in episode_num_strs):
+            logging.info("目录快照中缺少部分剧集的文件，重新列出下载目录...")
+            return self._ensure(episode_num_strs, reuse=False)
+        return True
+
+    def _ensure(self, episode_num_strs, reuse):
+        if not reuse:
+            entries = self.alist.list_files(self.root)
+            if entries is None: logging.error(f"无法列出下载目录 '{self.root}'，本轮无法查找待重命名的文件。"); return False
+            self.root_entries, self.taken_at, self.listed_dirs, self.files = entries, time.time(), set(), {}
+            self._index_entries(self.root, entries)
+        sub_dirs = [os.path.join(self.root, item.get("name", "")) for item in self.root_entries
+                    if item.get("is_dir") and any(ep in item.get("name", "") for ep in episode_num_strs)]
+        sub_dirs = [d for d in sub_dirs if d not in self.listed_dirs]
+        if sub_dirs:
+            with ThreadPoolExecutor(max_workers=max(1, min(DIR_LIST_CONCURRENCY, len(sub_dirs)))) as pool:
+                for sub_dir, files in zip(sub_dirs, pool.map(self.alist.list_files, sub_dirs)):
+                    if files is None: continue
+                    self.listed_dirs.add(sub_dir); self._index_entries(sub_dir, files)
+        return True
+
+    def find(self, episode_num_str):
+        """返回 (所在目录, 文件名)，未找到时返回 None。"""
+        return self.files.get(episode_num_str)
+
+    def record_rename(self, episode_num_str):
+        # 重命名后的文件不再以 [SBSUB][CONAN][NNNN] 开头，直接从索引中移除即可，无需重新列出目录
+        self.files.pop(episode_num_str, None)
+
+# --- 4. 调度器 (按任务截止时间调度，替代固定间隔的循环) ---
+def typical_download_duration(state, sample_size=10):
+    """
+    根据最近完成的剧集，返回从提交到转存完成的耗时中位数 (秒)；没有历史记录时返回 None。
+    优先使用 Alist 记录的转存完成时间 (transfer_done)，它与本程序何时去检查无关。
+    """
+    finished = sorted((h["completed"], h.get("transfer_done", h["completed"]) - h["added"]) for h in state.get("history", {}).values() if "added" in h and "completed" in h)
+    durations = sorted(duration for _, duration in finished[-sample_size:])
+    return durations[len(durations) // 2] if durations else None
+
+def next_task_check_at(task, typical_duration, now, poll_count=0):
+    """
+    计算任务的下一次检查时间，返回 (下一次检查时间, 是否已过最早检查时间)：
+    最早检查时间 (提交时间 + 以往耗时中位数的一半) 之前不检查，这样比中位数更快完成的下载也能被及时发现并拉低估计值；
+    之后从 TASK_MIN_POLL_SECONDS 开始按 poll_count 指数退避，最长不超过 ACTIVE_POLLING_INTERVAL_SECONDS。
+    没有 added_at 的任务 (来自旧版本的状态文件) 视为已过最早检查时间。
+    """
+    added_at = task.get("added_at")
+    if added_at is not None and now < added_at + (typical_duration or 0) * 0.5:
+        return max(added_at + typical_duration * 0.5, now + TASK_MIN_POLL_SECONDS), False
+    return now + min(TASK_MIN_POLL_SECONDS * 2 ** poll_count, ACTIVE_POLLING_INTERVAL_SECONDS), True
+
+def _catalog_peak_window(now):
+    """返回当前所在或下一次的更新高峰窗口 (开始时间戳, 结束时间戳)。"""
+    local = datetime.datetime.fromtimestamp(now)
+    duration = datetime.timedelta(hours=CATALOG_PEAK_DURATION_HOURS)
+    start = local.replace(hour=CATALOG_PEAK_START_HOUR, minute=0, second=0, microsecond=0) + datetime.timedelta(days=(CATALOG_PEAK_WEEKDAY - local.weekday()) % 7)
+    if start > local: start -= datetime.timedelta(days=7)
+    if start + duration <= local: start += datetime.timedelta(days=7)
+    return start.timestamp(), (start + duration).timestamp()
+
+def next_catalog_check_at(now):
+    """高峰窗口内每 CATALOG_PEAK_INTERVAL_SECONDS 检查一次数据源，其余时间每 IDLE_CHECK_INTERVAL_SECONDS 检查一次。"""
+    peak_start, peak_end = _catalog_peak_window(now)
+    if peak_start <= now < peak_end: return now + CATALOG_PEAK_INTERVAL_SECONDS
+    return min(now + IDLE_CHECK_INTERVAL_SECONDS, peak_start)
+
+class UpdateScheduler:
+    """
+    更新调度器：
+    - 数据源检查 (阶段一) 按自己的节奏运行，在每周更新高峰期间检查得更频繁；
+    - 每个待处理任务都有自己的下一次检查时间，阶段二只检查已到期的任务；
+      检查时间和退避次数只保存在内存中 (task_schedule)，仅检查而无结果时不写状态文件；
+    - 两类工作在一个小线程池中运行，一个缓慢的 Alist 请求不会拖住另一类工作。
+    """
+    def __init__(self, alist):
+        self.alist = alist
+        self.transfer_index = TransferIndex()
+        self.dir_snapshot = DirectorySnapshot(alist, DOWNLOAD_PATH)
+        self.catalog_due_at = 0.0
+        self.tasks_not_before = 0.0
+        self.task_schedule = {}
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="scheduler")
+
+    def wake(self):
+        self._wake.set()
+
+    def _submit(self, job_name, job):
+        with self._running_lock:
+            if job_name in self._running: return
+            self._running.add(job_name)
+        def run():
+            try: job()
+            except Exception: logging.exception(f"调度任务 '{job_name}' 执行出错。")
+            finally:
+                with self._running_lock: self._running.discard(job_name)
+                self.wake()
+        self._pool.submit(run)
+
+    def _next_check_at(self, task):
+        # 重启后内存中没有记录的任务立即到期
+        return self.task_schedule.get(task["task_id"], {}).get("next_check_at", 0)
+
+    def _is_running(self, job_name):
+        with self._running_lock: return job_name in self._running
+
+    def run_forever(self):
+        logging.info("更新调度器已启动...")
+        while True:
+            now = time.time()
+            pending_tasks = state_store.pending_tasks()
+            task_due_at = max(min((self._next_check_at(t) for t in pending_tasks), default=float("inf")), self.tasks_not_before)
+            # Alist 的熔断器打开时，两类工作都推迟到允许试探的时间，而不是让每个函数各自快速失败
+            alist_retry_at = get_circuit_breaker("alist").retry_at()
+            if now < alist_retry_at:
+                self.catalog_due_at, task_due_at = max(self.catalog_due_at, alist_retry_at), max(task_due_at, alist_retry_at)
+            with self._running_lock: idle = not self._running
+            if idle and (now >= self.catalog_due_at or now >= task_due_at): retry_budget.reset()
+            if now >= self.catalog_due_at and not self._is_running("catalog"):
+                # 先按较短的间隔推迟，工作完成后会按正常节奏重新安排；工作出错时也不会连续重试
+                self.catalog_due_at = now + ACTIVE_POLLING_INTERVAL_SECONDS; self._submit("catalog", self.run_catalog_job)
+            if now >= task_due_at and not self._is_running("tasks"):
+                self.tasks_not_before = now + TASK_MIN_POLL_SECONDS; self._submit("tasks", self.run_task_job)
+            deadlines = [d for name, d in (("catalog", self.catalog_due_at), ("tasks", task_due_at)) if not self._is_running(name)]
+            wait_seconds = max(0.0, min(deadlines, default=IDLE_CHECK_INTERVAL_SECONDS) - time.time())
+            self._wake.wait(timeout=min(wait_seconds, IDLE_CHECK_INTERVAL_SECONDS)); self._wake.clear()
+
+    @PHASE_DURATION_SECONDS.labels(phase="phase_one").time()
+    def run_catalog_job(self):
+        logging.info("-" * 30); logging.info("--- 阶段一：检查并添加新剧集 ---")
+        state = state_store.snapshot()
         last_completed_episode = state.get("last_completed_episode", float(START_EPISODE))
         pending_tasks = state.get("pending_tasks", [])
         logging.info(f"当前最后确认完成的集数是: {last_completed_episode}"); logging.info(f"有 {len(pending_tasks)} 个任务待处理。")
-        token = get_alist_token()
-        if not token:
-            logging.warning("无法获取 Alist token，将在下次检查时重试。"); time.sleep(ACTIVE_POLLING_INTERVAL_SECONDS); continue
-        
-        logging.info("\n--- 阶段一：检查并添加新剧集 ---")
+        if not self.alist.get_token():
+            logging.warning("无法获取 Alist token，将在下次检查时重试。"); return
+
+        now = time.time()
         new_episodes = find_new_episodes(last_completed_episode)
         if not new_episodes: logging.info("未发现需要下载的新剧集。")
         else:
             logging.info(f"发现 {len(new_episodes)} 个新剧集，准备添加到 Alist...")
-            for episode_num, episode_info in new_episodes:
-                if any(p.get('episode_number') == episode_num for p in pending_tasks): logging.info(f"剧集 {episode_num} 已在待处理列表中，跳过添加。"); continue
-                downloads = episode_info[7].get("WEBRIP", []); magnet_found = False
-                for item in downloads:
-                    if len(item) > 2 and item[1] == "简繁日MKV":
-                        magnet = item[2] + "".join(TRACKERS_TO_ADD); desired_filename = f"{episode_info[0]} {episode_info[1]}.mkv"; task_id = add_offline_download(token, magnet)
-                        if task_id:
-                            pending_tasks.append({"task_id": task_id, "episode_number": episode_num, "desired_filename": desired_filename, "rename_attempts": 0})
-                            save_state({**state, "pending_tasks": pending_tasks}); logging.info(f"剧集 {episode_num} (任务ID: {task_id}) 已添加到待处理列表。"); magnet_found = True; break
-                if not magnet_found: logging.warning(f"在剧集 {episode_num} 中未找到 '简繁日MKV' 格式的下载链接。")
-        
-        logging.info("\n--- 阶段二：根据转存结果检查任务状态 ---")
-        if not pending_tasks:
-            logging.info("没有待处理的任务需要检查。")
-        else:
-            completed_transfers = get_completed_transfer_tasks(token)
-            if completed_transfers is None:
-                logging.warning("无法获取 Alist 已完成转存任务列表，将在下次检查时重试。")
+            download_requests = build_download_requests(new_episodes, pending_tasks)
+            task_ids = submit_download_requests(self.alist, download_requests)
+            typical_duration, added_at = typical_download_duration(state), time.time()
+            new_tasks = []
+            for download_request, task_id in zip(download_requests, task_ids):
+                episode_num = download_request["episode_number"]
+                if not task_id: logging.warning(f"剧集 {episode_num} 添加到 Alist 失败，将在下次检查时重试。"); continue
+                new_task = {"task_id": task_id, "episode_number": episode_num, "desired_filename": download_request["desired_filename"], "rename_attempts": 0, "added_at": added_at}
+                self.task_schedule[task_id] = {"next_check_at": next_task_check_at(new_task, typical_duration, added_at)[0], "poll_count": 0}
+                new_tasks.append(new_task)
+                logging.info(f"剧集 {episode_num} (任务ID: {task_id}) 已添加到待处理列表。")
+            if new_tasks:
+                with state_store.transaction() as state:
+                    state["pending_tasks"].extend(new_tasks)
+                    for new_task in new_tasks: record_episode_event(state, new_task["episode_number"], "added")
+                logging.info(f"已将 {len(new_tasks)} 个新任务一次性写入状态文件。")
+                self.wake()
+        self.catalog_due_at = next_catalog_check_at(now)
+        logging.info(f"下一次检查数据源的时间: {datetime.datetime.fromtimestamp(self.catalog_due_at):%Y-%m-%d %H:%M:%S}")
+
+    @PHASE_DURATION_SECONDS.labels(phase="phase_two").time()
+    def run_task_job(self, due_only=True):
+        now = time.time()
+        state = state_store.snapshot()
+        pending_tasks = state.get("pending_tasks", [])
+        due_tasks = [t for t in pending_tasks if not due_only or self._next_check_at(t) <= now]
+        if not due_tasks: return
+        logging.info("-" * 30); logging.info("--- 阶段二：根据转存结果检查任务状态 ---")
+        logging.info(f"{len(pending_tasks)} 个待处理任务中有 {len(due_tasks)} 个已到检查时间。")
+        if not self.alist.get_token():
+            logging.warning("无法获取 Alist token，将在下次检查时重试。"); return
+        completed_transfers = self.alist.get_completed_transfer_tasks()
+        if completed_transfers is None:
+            logging.warning("无法获取 Alist 已完成转存任务列表，将在下次检查时重试。"); return
+
+        new_transfer_count = self.transfer_index.update(completed_transfers)
+        logging.info(f"本次新增 {new_transfer_count} 个已完成的转存任务，索引中共有 {len(self.transfer_index.by_episode)} 个剧集的转存记录。")
+
+        completed_episode_strs = {ep for ep in (str(t['episode_number']).split('.')[0] for t in due_tasks) if self.transfer_index.lookup(ep)}
+        dir_listed = True
+        if completed_episode_strs:
+            logging.info(f"有 {len(completed_episode_strs)} 个剧集的转存已完成，开始扫描文件系统并准备重命名...")
+            dir_listed = self.dir_snapshot.refresh(completed_episode_strs)
+
+        tasks_to_remove, given_up_ids, attempted_ids = [], set(), set()
+        typical_duration = typical_download_duration(state)
+        for task in due_tasks:
+            episode_num_str = str(task['episode_number']).split('.')[0]
+            match_pattern = f"[SBSUB][CONAN][{episode_num_str}]"
+            matched_transfer_name = self.transfer_index.lookup(episode_num_str)
+
+            if matched_transfer_name is not None and not dir_listed:
+                # 列出下载目录失败时无法判断文件是否存在，只重新安排检查，不计入重命名尝试次数
+                logging.warning(f"剧集 {episode_num_str} 的转存已完成，但下载目录列出失败，将在下次检查时重新查找。")
+            elif matched_transfer_name is not None:
+                logging.info(f"匹配成功！剧集 {episode_num_str} 的转存任务已完成。匹配到的文件名: '{matched_transfer_name}'")
+                located = self.dir_snapshot.find(episode_num_str)
+                found = located is not None
+                if found: source_dir, target_file = located; logging.info(f"在目录 '{source_dir}' 中找到目标文件: '{target_file}'")
+
+                rename_success = False
+                if found:
+                    desired_filename = task.get("desired_filename")
+                    if target_file != desired_filename: rename_success = self.alist.rename_file(source_dir, target_file, desired_filename)
+                    else: logging.info("文件名已符合要求，无需重命名。"); rename_success = True
+                    if rename_success: self.dir_snapshot.record_rename(episode_num_str)
+
+                if rename_success:
+                    if task.get("added_at"): SUBMIT_TO_RENAME_SECONDS.observe(time.time() - task["added_at"])
+                    tasks_to_remove.append(task); continue
+                task['rename_attempts'] = task.get('rename_attempts', 0) + 1; attempted_ids.add(task["task_id"])
+                if not found: logging.error(f"扫描完 '{DOWNLOAD_PATH}' 后未能找到匹配文件。当前尝试次数: {task['rename_attempts']}/{MAX_RENAME_ATTEMPTS}。")
+                else: logging.error(f"重命名剧集 {episode_num_str} 失败。当前尝试次数: {task['rename_attempts']}/{MAX_RENAME_ATTEMPTS}。")
+                if task['rename_attempts'] >= MAX_RENAME_ATTEMPTS:
+                    logging.critical(f"剧集 {episode_num_str} 已达到最大重试次数，将放弃该任务！"); tasks_to_remove.append(task); given_up_ids.add(task["task_id"]); continue
             else:
-                if completed_transfers:
-                    logging.info(f"从 Alist 获取到 {len(completed_transfers)} 个已完成的转存任务名称如下:")
-                    for i, transfer in enumerate(completed_transfers):
-                        logging.info(f"  {i+1}: {transfer.get('name', 'N/A')}")
-
-                tasks_to_remove, state_changed = [], False
-                for task in pending_tasks:
-                    episode_num_str = str(task['episode_number']).split('.')[0]
-                    match_pattern = f"[SBSUB][CONAN][{episode_num_str}]"
-                    logging.info(f"正在为待处理任务 (剧集 {episode_num_str}) 寻找匹配项，搜索模式为: '{match_pattern}'")
-
-                    is_completed = False
-                    matched_transfer_name = ""
-                    for transfer in completed_transfers:
-                        transfer_name = transfer.get('name', '')
-                        # 更新：修复匹配逻辑
-                        if match_pattern in transfer_name and '.mkv' in transfer_name:
-                            is_completed = True
-                            matched_transfer_name = transfer_name
-                            break
-                    
-                    if is_completed:
-                        logging.info(f"匹配成功！剧集 {episode_num_str} 的转存任务已完成。匹配到的文件名: '{matched_transfer_name}'")
-                        logging.info("开始扫描文件系统并准备重命名...")
-                        content_in_download_path = list_files(token, DOWNLOAD_PATH)
-                        target_file, source_dir, found = None, "", False
-                        if content_in_download_path is not None:
-                            for item in content_in_download_path:
-                                name = item.get("name", "");
-                                if item.get("is_dir") and episode_num_str in name:
-                                    sub_dir_path = os.path.join(DOWNLOAD_PATH, name)
-                                    files_in_subdir = list_files(token, sub_dir_path)
-                                    if files_in_subdir:
-                                        for sub_file in files_in_subdir:
-                                            sub_name = sub_file.get("name", "")
-                                            if not sub_file.get("is_dir") and sub_name.startswith(match_pattern) and sub_name.endswith(".mkv"):
-                                                target_file, source_dir, found = sub_name, sub_dir_path, True; logging.info(f"在子目录 '{name}' 中找到目标文件: '{target_file}'"); break
-                                elif not item.get("is_dir") and name.startswith(match_pattern) and name.endswith(".mkv"):
-                                    target_file, source_dir, found = name, DOWNLOAD_PATH, True; logging.info(f"在主下载目录中找到目标文件: '{target_file}'")
-                                if found: break
-                        
-                        rename_success = False
-                        if found and target_file:
-                            desired_filename = task.get("desired_filename")
-                            if target_file != desired_filename: rename_success = rename_file(token, source_dir, target_file, desired_filename)
-                            else: logging.info("文件名已符合要求，无需重命名。"); rename_success = True
-                        
-                        if rename_success: tasks_to_remove.append(task)
-                        else:
-                            task['rename_attempts'] = task.get('rename_attempts', 0) + 1
-                            if not found: logging.error(f"扫描完 '{DOWNLOAD_PATH}' 后未能找到匹配文件。当前尝试次数: {task['rename_attempts']}/{MAX_RENAME_ATTEMPTS}。")
-                            else: logging.error(f"重命名剧集 {episode_num_str} 失败。当前尝试次数: {task['rename_attempts']}/{MAX_RENAME_ATTEMPTS}。")
-                            if task['rename_attempts'] >= MAX_RENAME_ATTEMPTS:
-                                logging.critical(f"剧集 {episode_num_str} 已达到最大重试次数，将放弃该任务！"); tasks_to_remove.append(task)
-                        state_changed = True
-                    else:
-                        logging.info(f"检查了所有已完成的转存任务后，未能找到剧集 {episode_num_str} 的匹配项。该任务的转存尚未完成或文件名不匹配。")
-
-                if state_changed:
-                    state["pending_tasks"] = [p for p in pending_tasks if p not in tasks_to_remove]
-                    completed_episodes = {state.get("last_completed_episode", float(START_EPISODE))}
-                    for removed_task in tasks_to_remove:
-                        completed_episodes.add(removed_task["episode_number"])
-                    if completed_episodes:
-                        new_last_completed = max(completed_episodes)
-                        if new_last_completed > state["last_completed_episode"]:
-                            state["last_completed_episode"] = new_last_completed; logging.info(f"更新最后完成的集数为: {new_last_completed}")
-                    save_state(state); logging.info("状态文件已更新。")
-
-        final_state = load_state()
-        if final_state.get("pending_tasks"):
-            wait_interval = ACTIVE_POLLING_INTERVAL_SECONDS
-            logging.info(f"\n发现待处理任务。将在较短的 {wait_interval} 秒后进行下一次检查...")
-        else:
-            wait_interval = IDLE_CHECK_INTERVAL_SECONDS
-            logging.info(f"\n所有任务已完成。将在常规的 {wait_interval} 秒后进行下一次检查...")
-        time.sleep(wait_interval)
+                logging.info(f"已完成的转存任务中没有剧集 {episode_num_str} ('{match_pattern}') 的匹配项。该任务的转存尚未完成或文件名不匹配。")
+            schedule = self.task_schedule.setdefault(task["task_id"], {"poll_count": 0})
+            schedule["next_check_at"], overdue = next_task_check_at(task, typical_duration, now, schedule["poll_count"])
+            if overdue: schedule["poll_count"] += 1
+
+        removed_ids = {t["task_id"] for t in tasks_to_remove}
+        for task_id in removed_ids: self.task_schedule.pop(task_id, None)
+        # 只有任务被重命名、放弃或重命名尝试次数变化时才需要写状态文件；单纯的检查只更新内存中的调度信息
+        if not removed_ids and not attempted_ids: return
+        changed_tasks = {t["task_id"]: t for t in due_tasks if t["task_id"] in attempted_ids}
+        with state_store.transaction() as state:
+            # 以内存中的最新状态为准，只合并本轮有变化的任务，避免覆盖阶段一同时添加的新任务
+            state["pending_tasks"] = [changed_tasks.get(p["task_id"], p) for p in state["pending_tasks"] if p["task_id"] not in removed_ids]
+            for removed_task in tasks_to_remove:
+                episode_num = removed_task["episode_number"]
+                record_episode_event(state, episode_num, "failed" if removed_task["task_id"] in given_up_ids else "completed")
+                # 早于提交时间的完成时间说明匹配到的是该集以前的转存记录，不能用于估算下载耗时
+                episode_history, transfer_done = state["history"][str(episode_num)], self.transfer_index.finished_at.get(str(episode_num).split('.')[0])
+                if transfer_done and removed_task["task_id"] not in given_up_ids and transfer_done >= episode_history.get("added", float("inf")): episode_history["transfer_done"] = transfer_done
+            if tasks_to_remove:
+                new_last_completed = max(t["episode_number"] for t in tasks_to_remove)
+                if new_last_completed > state["last_completed_episode"]:
+                    state["last_completed_episode"] = new_last_completed; logging.info(f"更新最后完成的集数为: {new_last_completed}")
+        logging.info("状态文件已更新。")
+
+def run_update_checker():
+    logging.info("更新检查器线程已启动...")
+    UpdateScheduler(AlistClient(ALIST_URL, ALIST_USERNAME, ALIST_PASSWORD)).run_forever()
 
-# --- 5. Web 服务器 (无变化) ---
+# --- 5. Web 服务器 ---
 @app.route('/')
 def status_page():
-    state = load_state()
-    return render_template('index.html', last_episode=state.get('last_completed_episode', 'N/A'), pending_tasks=state.get('pending_tasks', []))
+    last_episode = state_store.last_completed_episode()
+    return render_template('index.html', last_episode='N/A' if last_episode is None else last_episode, pending_tasks=state_store.pending_tasks(), retry_status=retry_status())
+
+@app.route('/api/status')
+def api_status():
+    _, etag, body = state_store.status_snapshot()
+    response = Response(body, content_type="application/json; charset=utf-8", headers={"Cache-Control": "no-cache"})
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+sse_subscribers = threading.BoundedSemaphore(SSE_MAX_SUBSCRIBERS) if SSE_MAX_SUBSCRIBERS > 0 else None
+
+@app.route('/api/events')
+def api_events():
+    """
+    以 server-sent events 推送状态变化：每个新增、完成或放弃的任务各发送一个事件，随后发送最新的完整状态。
+    同时订阅数超过 SSE_MAX_SUBSCRIBERS 时返回 503；每个连接最多持续 SSE_STREAM_MAX_SECONDS 秒后结束，客户端按 retry 提示自动重连。
+    """
+    if sse_subscribers is None or not sse_subscribers.acquire(blocking=False):
+        return Response("too many event stream subscribers\n", status=503, mimetype="text/plain", headers={"Retry-After": str(SSE_RETRY_SECONDS)})
+    def stream():
+        deadline = time.monotonic() + SSE_STREAM_MAX_SECONDS
+        version, etag, body = state_store.status_snapshot()
+        yield f"retry: {SSE_RETRY_SECONDS * 1000}\nid: {etag}\nevent: status\ndata: {body.decode('utf-8')}\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return
+            change = state_store.wait_for_change(version, timeout=min(SSE_KEEPALIVE_SECONDS, remaining))
+            if change is None: yield ": keep-alive\n\n"; continue
+            (version, etag, body), events = change
+            for event in events:
+                yield f"event: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            yield f"id: {etag}\nevent: status\ndata: {body.decode('utf-8')}\n\n"
+    response = Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # 无论流是正常结束还是客户端断开，服务器关闭响应时都会释放订阅名额
+    response.call_on_close(sse_subscribers.release)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
-# --- 6. 启动入口 (无变化) ---
+# --- 6. 启动入口 ---
 if __name__ == "__main__":
     check_env_vars(); logging.info("脚本启动...")
-    if not os.path.exists("templates"): os.makedirs("templates")
-    index_html_path = os.path.join("templates", "index.html")
-    if not os.path.exists(index_html_path):
-        with open(index_html_path, "w", encoding="utf-8") as f:
-            f.write("""<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>下载器状态</title><style>body { font-family: sans-serif; line-height: 1.6; margin: 2em; } h1, h2 { color: #333; } ul { list-style-type: none; padding-left: 0; } li { background: #f4f4f4; margin-bottom: 5px; padding: 10px; border-radius: 5px; }</style></head><body><h1>Alist 自动下载器状态</h1><p><strong>最新完成的剧集:</strong> {{ last_episode }}</p><h2>待处理任务 ({{ pending_tasks|length }})</h2><ul>{% for task in pending_tasks %}<li>剧集 {{ task.episode_number }} (任务ID: {{ task.task_id }}) - 重命名尝试: {{ task.rename_attempts }} / """ + str(MAX_RENAME_ATTEMPTS) + """</li>{% else %}<li>无待处理任务</li>{% endfor %}</ul></body></html>""")
-    
     checker_thread = threading.Thread(target=run_update_checker, daemon=True)
     checker_thread.start()
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # 使用多线程的 waitress 作为生产环境 WSGI 服务器；每个 /api/events 推送连接会占用一个线程
+    serve(app, host='0.0.0.0', port=5000, threads=WEB_SERVER_THREADS)